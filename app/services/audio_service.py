@@ -1,46 +1,122 @@
 import acoustid
+import aiohttp
+import asyncio
+import diskcache
+import functools
+import hashlib
+import itertools
 import os
+import re
+import shutil
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 import logging
+import orjson
 from fastapi import UploadFile
 
 logger = logging.getLogger(__name__)
 
+# Optional in-process fingerprinting: PyAV decodes, libchromaprint fingerprints.
+# Without them we fall back to pyacoustid's fpcalc subprocess.
+try:
+    import av
+    import chromaprint
+    NATIVE_FINGERPRINT = True
+except ImportError:
+    NATIVE_FINGERPRINT = False
+
+
+class NativeFingerprintError(Exception):
+    """In-process decoding failed on a stream that fpcalc can't read directly"""
+
+
+def _confidence_table(high: float, medium: float) -> tuple:
+    return tuple(
+        "high" if i / 100 >= high else "medium" if i / 100 >= medium else "low"
+        for i in range(101)
+    )
+
 
 class AudioService:
     
     # Supported audio formats
-    SUPPORTED_FORMATS = {'.mp3', '.flac', '.ogg', '.m4a', '.wav', '.wma', '.aiff','.aac'}
+    SUPPORTED_FORMATS = frozenset({'.mp3', '.flac', '.ogg', '.m4a', '.wav', '.wma', '.aiff','.aac'})
+    _SUPPORTED_FORMAT_RE = re.compile(
+        # Require a name before the extension so bare dotfiles like ".mp3" fail, as with Path.suffix
+        r"(?<=[^/\\])(?:" + "|".join(re.escape(ext) for ext in sorted(SUPPORTED_FORMATS)) + r")\Z",
+        re.IGNORECASE
+    )
     
     # Match score thresholds
     HIGH_CONFIDENCE = 0.8
     MEDIUM_CONFIDENCE = 0.5
     
-    def __init__(self):
+    # Confidence label for each whole-percent score
+    _CONFIDENCE_LEVELS = _confidence_table(HIGH_CONFIDENCE, MEDIUM_CONFIDENCE)
+    
+    UPLOAD_CHUNK_SIZE = 1 << 20  # bytes
+    
+    # AcoustID only matches on the first ~2 minutes of a fingerprint
+    FINGERPRINT_MAX_LENGTH = 120  # seconds
+    
+    ACOUSTID_LOOKUP_URL = "https://api.acoustid.org/v2/lookup"
+    
+    # Lookup cache settings
+    CACHE_TTL = 7 * 24 * 3600  # seconds
+    FINGERPRINT_TTL = 30 * 24 * 3600  # seconds
+    CACHE_SIZE_LIMIT = 64 * 1024 * 1024  # bytes on disk before least-recently-stored entries are evicted
+    CACHE_HASH_CHUNK_SIZE = 1 << 20  # bytes read per step when hashing for the cache key
+    MEMO_SIZE = 256  # entries kept in memory in front of the disk cache
+    
+    def __init__(
+        self,
+        session: Optional[aiohttp.ClientSession] = None,
+        executor: Optional[ThreadPoolExecutor] = None
+    ):
         self.api_key = os.getenv("ACOUSTID_API_KEY")
         if not self.api_key:
             logger.warning("ACOUSTID_API_KEY not set in environment variables")
         
         self.temp_dir = tempfile.gettempdir()
+        
+        # Temp upload names: pid + counter seeded from start time (created with O_EXCL)
+        self._tmp_prefix = f"audio_{os.getpid():x}_"
+        self._tmp_counter = itertools.count(int(time.time()))
+        
+        # Shared HTTP session and worker pool, set by the app on startup
+        self.session = session
+        self.executor = executor
+        
+        # Parsed result summaries: path -> (mtime_ns, size, (status, file, title))
+        self._results_cache = {}
+        
+        # Persistent cache of fingerprints and AcoustID matches, keyed by content hash
+        # (diskcache is thread- and process-safe, so only the in-memory layer needs a lock)
+        self._cache = diskcache.Cache(
+            os.path.join(self.temp_dir, "acoustid_cache"),
+            size_limit=self.CACHE_SIZE_LIMIT
+        )
+        self._cache.expire()
+        self._memo = {}  # key -> (expires_at or None, value)
+        self._memo_lock = threading.Lock()
     
     def api_key_configured(self) -> bool:
         return bool(self.api_key)
     
     def is_valid_audio_format(self, filename: str) -> bool:
-        file_ext = Path(filename).suffix.lower()
-        return file_ext in self.SUPPORTED_FORMATS
+        return self._SUPPORTED_FORMAT_RE.search(filename) is not None
     
     async def save_upload(self, file: UploadFile) -> str:
         try:
             # Create temp file with original extension
             file_ext = Path(file.filename).suffix
-            temp_path = os.path.join(self.temp_dir, f"audio_{os.urandom(8).hex()}{file_ext}")
             
-            # Save file
-            with open(temp_path, "wb") as buffer:
-                contents = await file.read()
-                buffer.write(contents)
+            # Stream to disk in chunks off the event loop
+            temp_path = await asyncio.to_thread(self._copy_upload, file, file_ext)
             
             logger.info(f"File saved to: {temp_path}")
             return temp_path
@@ -49,7 +125,88 @@ class AudioService:
             logger.error(f"Failed to save upload: {str(e)}")
             raise
     
-    def identify_audio(self, file_path: str) -> dict:
+    def summarize_results(self, output_dir: str) -> list:
+        """Summarize saved result files, re-reading only those changed on disk"""
+        results = []
+        seen = set()
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                if not (entry.name.endswith('.json') and entry.is_file()):
+                    continue
+                st = entry.stat()
+                seen.add(entry.path)
+                cached = self._results_cache.get(entry.path)
+                if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                    summary = cached[2]
+                else:
+                    try:
+                        with open(entry.path, 'rb') as f:
+                            result_data = orjson.loads(f.read())
+                    except (OSError, orjson.JSONDecodeError) as e:
+                        logger.warning(f"Skipping unreadable result {entry.name}: {e}")
+                        continue
+                    title = (result_data.get("top_match") or {}).get("title") if result_data.get("status") == "found" else None
+                    summary = (result_data.get("status"), result_data.get("file"), title)
+                    self._results_cache[entry.path] = (st.st_mtime_ns, st.st_size, summary)
+                status, file, title = summary
+                results.append({
+                    "filename": entry.name,
+                    "status": status,
+                    "file": file,
+                    "title": title
+                })
+        
+        # Drop entries for files that have been removed
+        for path in self._results_cache.keys() - seen:
+            del self._results_cache[path]
+        return results
+    
+    def _copy_upload(self, file: UploadFile, file_ext: str) -> str:
+        file.file.seek(0)
+        while True:
+            temp_path = os.path.join(self.temp_dir, f"{self._tmp_prefix}{next(self._tmp_counter):08x}{file_ext}")
+            # Names are predictable, so create exclusively rather than follow a planted file or symlink
+            try:
+                buffer = open(temp_path, "xb")
+            except FileExistsError:
+                continue
+            with buffer:
+                shutil.copyfileobj(file.file, buffer, self.UPLOAD_CHUNK_SIZE)
+            return temp_path
+    
+    async def identify_audio(self, file_path: str) -> dict:
+        try:
+            return await self._identify(file_path, Path(file_path).name)
+        
+        finally:
+            #  Only delete files created in system temp directory
+            try:
+                abs_file = os.path.abspath(file_path)
+                abs_temp = os.path.abspath(self.temp_dir)
+
+                if abs_file.startswith(abs_temp):
+                    self._cleanup_file(file_path)
+            except Exception as e:
+                logger.error(f"Cleanup check failed: {e}")  
+    
+    async def identify_upload(self, file: UploadFile) -> dict:
+        if not NATIVE_FINGERPRINT:
+            # fpcalc only reads from disk (and mp4-style containers need seeking), so stage the upload
+            return await self.identify_audio(await self.save_upload(file))
+        
+        # Decode straight from the spooled upload, no temp copy
+        try:
+            return await self._identify(file.file, file.filename)
+        except NativeFingerprintError as e:
+            # Stage it on disk so fpcalc can take over
+            logger.warning(f"Native fingerprinting failed for upload, retrying with fpcalc: {e}")
+            file_path = await self.save_upload(file)
+            try:
+                return await self._identify(file_path, file.filename, native=False)
+            finally:
+                self._cleanup_file(file_path)
+    
+    async def _identify(self, source, name: str, native: bool = True) -> dict:
         try:
             if not self.api_key:
                 return {
@@ -57,64 +214,180 @@ class AudioService:
                     "error": "AcoustID API key not configured"
                 }
             
-            logger.info(f"Identifying audio: {file_path}")
+            logger.info(f"Identifying audio: {name}")
+            
+            key = await self._run_blocking(self._cache_key, source)
+            matches = await self._run_blocking(self._get_cached_matches, key)
+            if matches is None:
+                # Fingerprint off the event loop, then query AcoustID
+                duration, fingerprint = await self._run_blocking(self._fingerprint, key, source, native)
+                response = await self._lookup(fingerprint, duration)
+                matches = self._process_results(acoustid.parse_lookup_result(response))
+                logger.debug("AcoustID matches: %s", matches)
+                await self._run_blocking(self._store_matches, key, matches)
+            else:
+                logger.info(f"Cache hit for: {name}")
             
-            # Query AcoustID
-            results =list(acoustid.match(self.api_key, file_path))
-            print("RAW RESULTS:\n", results)       
-            if not results:
+            if not matches:
                 return {
                     "status": "not_found",
                     "message": "No match found in AcoustID database",
-                    "file": Path(file_path).name
+                    "file": name
                 }
-            # Process results
-            matches = []
-            for score, recording_id, title, artist in results:
-                confidence = self._get_confidence_level(score)
-                matches.append({
-                    "title": title,
-                    "artist": artist,
-                    "recording_id": recording_id,
-                    "match_score": round(score, 2),
-                    "confidence": confidence
-                })
             valid_matches = [m for m in matches if m["title"] and m["artist"]]
 
             top_match = valid_matches[0] if valid_matches else (matches[0] if matches else None)
             return {
                 "status": "found",
-                "file": Path(file_path).name,
+                "file": name,
                 "matches": matches,
                 "top_match": top_match
             }
             
+        except NativeFingerprintError:
+            raise
         except Exception as e:
             logger.error(f"Identification error: {str(e)}")
             return {
                 "status": "error",
                 "error": str(e),
-                "file": Path(file_path).name
+                "file": name
             }
-        
-        finally:
-            #  Only delete files created in system temp directory
-            try:
-                abs_file = os.path.abspath(file_path)
-                abs_temp = os.path.abspath(self.temp_dir)
-
-                if abs_file.startswith(abs_temp):
-                    self._cleanup_file(file_path)
-            except Exception as e:
-                logger.error(f"Cleanup check failed: {e}")  
+    
+    async def _run_blocking(self, func, *args):
+        """Run blocking work on the service pool (or the loop default) without stalling the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+    
+    async def _lookup(self, fingerprint: str, duration: float) -> dict:
+        if isinstance(fingerprint, bytes):
+            fingerprint = fingerprint.decode("ascii")
+        data = {
+            "format": "json",
+            "client": self.api_key,
+            "duration": str(int(duration)),
+            "fingerprint": fingerprint,
+            "meta": "recordings"
+        }
+        if self.session is not None:
+            return await self._post_lookup(self.session, data)
+        async with aiohttp.ClientSession() as session:
+            return await self._post_lookup(session, data)
+    
+    async def _post_lookup(self, session: aiohttp.ClientSession, data: dict) -> dict:
+        async with session.post(self.ACOUSTID_LOOKUP_URL, data=data) as response:
+            response.raise_for_status()
+            return orjson.loads(await response.read())
+    
+    def _process_results(self, results) -> list:
+        return [
+            {
+                "title": title,
+                "artist": artist,
+                "recording_id": recording_id,
+                "match_score": round(score, 2),
+                "confidence": self._get_confidence_level(score)
+            }
+            for score, recording_id, title, artist in results
+        ]
+    
+    def _cache_key(self, source) -> str:
+        """Hash the full file contents so only identical audio shares cached results"""
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                return self._hash_contents(f)
+        return self._hash_contents(source)
+    
+    def _hash_contents(self, f) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        f.seek(0)
+        for chunk in iter(lambda: f.read(self.CACHE_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        f.seek(0)
+        return digest.hexdigest()
+    
+    def _cache_get(self, key: str):
+        with self._memo_lock:
+            entry = self._memo.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.time():
+                    return value
+                del self._memo[key]
+        try:
+            value, expires_at = self._cache.get(key, expire_time=True)
+        except Exception as e:
+            logger.error(f"Cache read failed: {e}")
+            return None
+        if value is not None:
+            self._remember(key, value, expires_at)
+        return value
+    
+    def _remember(self, key: str, value, expires_at: Optional[float]) -> None:
+        with self._memo_lock:
+            if key not in self._memo and len(self._memo) >= self.MEMO_SIZE:
+                self._memo.pop(next(iter(self._memo)), None)
+            self._memo[key] = (expires_at, value)
+    
+    def _cache_set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        self._remember(key, value, time.time() + ttl if ttl is not None else None)
+        try:
+            self._cache.set(key, value, expire=ttl)
+        except Exception as e:
+            logger.error(f"Cache write failed: {e}")
+    
+    def _get_cached_matches(self, key: str):
+        return self._cache_get(f"matches:{key}")
+    
+    def _store_matches(self, key: str, matches: list) -> None:
+        self._cache_set(f"matches:{key}", matches, ttl=self.CACHE_TTL)
+    
+    def _fingerprint(self, key: str, source, native: bool = True) -> tuple:
+        # Fingerprints don't change with the AcoustID data, so they outlive the match TTL
+        fp = self._cache_get(f"fingerprint:{key}")
+        if fp is None:
+            if native and NATIVE_FINGERPRINT:
+                try:
+                    fp = self._fingerprint_native(source)
+                except Exception as e:
+                    # fpcalc can only fall back for files already on disk
+                    if not isinstance(source, str):
+                        raise NativeFingerprintError(str(e)) from e
+                    logger.warning(f"Native fingerprinting failed, using fpcalc: {e}")
+            if fp is None:
+                fp = acoustid.fingerprint_file(source, maxlength=self.FINGERPRINT_MAX_LENGTH)
+            self._cache_set(f"fingerprint:{key}", fp, ttl=self.FINGERPRINT_TTL)
+        return fp
+    
+    def _fingerprint_native(self, source) -> tuple:
+        """Decode to mono 16-bit PCM with PyAV and fingerprint it with libchromaprint"""
+        with av.open(source) as container:
+            stream = container.streams.audio[0]
+            rate = stream.codec_context.sample_rate
+            resampler = av.AudioResampler(format="s16", layout="mono", rate=rate)
+            fingerprinter = chromaprint.Fingerprinter()
+            fingerprinter.start(rate, 1)
+            
+            remaining = rate * self.FINGERPRINT_MAX_LENGTH
+            decoded = 0
+            for frame in container.decode(stream):
+                for pcm in resampler.resample(frame):
+                    samples = min(pcm.samples, remaining)
+                    fingerprinter.feed(bytes(pcm.planes[0])[:samples * 2])
+                    remaining -= samples
+                    decoded += samples
+                if remaining <= 0:
+                    break
+            fingerprint = fingerprinter.finish()
+            
+            if container.duration:
+                duration = container.duration / av.time_base
+            else:
+                duration = decoded / rate
+        return duration, fingerprint
     
     def _get_confidence_level(self, score: float) -> str:
-        if score >= self.HIGH_CONFIDENCE:
-            return "high"
-        elif score >= self.MEDIUM_CONFIDENCE:
-            return "medium"
-        else:
-            return "low"
+        return self._CONFIDENCE_LEVELS[min(100, max(0, int(score * 100)))]
     
     def _cleanup_file(self, file_path: str) -> None:
         try:
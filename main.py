@@ -1,12 +1,16 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+import aiohttp
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from app.services.audio_service import AudioService
 import os
 from dotenv import load_dotenv
 load_dotenv()
-import json
+import orjson
+import tempfile
 from pathlib import Path
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -17,7 +21,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Audio Copyright Detector",
     description="Detect copyrighted music using Chromaprint + AcoustID",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware for web interface
@@ -41,18 +46,46 @@ os.makedirs(OUTPUT_PATH, exist_ok=True)
 os.makedirs("static", exist_ok=True)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+def save_result(result: dict, output_file: str) -> None:
+    """Write a detection result as indented JSON"""
+    # Write beside the target and swap it in, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_file), suffix=".tmp")
+    try:
+        os.fchmod(fd, 0o644)  # mkstemp creates 0600; keep results readable as before
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
 @app.on_event("startup")
 async def startup():
     """Initialize services on startup"""
     logger.info("Audio Copyright Detector API started")
 
+    # Resolve the web interface once; it only changes on deploy
+    index_path = Path("index.html")
+    app.state.index_path = index_path.resolve() if index_path.is_file() else None
+    app.state.index_stat = app.state.index_path.stat() if app.state.index_path else None
+
+    # One pooled HTTP session for all AcoustID lookups (keep-alive + DNS cache)
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75, ttl_dns_cache=300)
+    )
+    audio_service.session = app.state.http
+
+    # Bounded pool for fingerprinting and cache I/O so detections run in parallel
+    app.state.pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="audio")
+    audio_service.executor = app.state.pool
+
     try:
         filename = "test16.wav"
         file_path = os.path.join(INPUT_PATH, filename)
 
         if os.path.isfile(file_path):
             logger.info(f"Auto testing file: {file_path}")
-            result = audio_service.identify_audio(file_path)
+            result = await audio_service.identify_audio(file_path)
 
             #  SAVE JSON (missing currently)
             output_file = os.path.join(
@@ -60,8 +93,7 @@ async def startup():
                 f"{Path(filename).stem}_copyright.json"
             )
 
-            with open(output_file, "w") as f:
-                json.dump(result, f, indent=2)
+            save_result(result, output_file)
 
             logger.info(f"Startup result saved to: {output_file}")
 
@@ -77,15 +109,19 @@ async def startup():
 async def shutdown():
     """Cleanup on shutdown"""
     logger.info("Audio Copyright Detector API shutting down")
+    audio_service.session = None
+    audio_service.executor = None
+    await app.state.http.close()
+    app.state.pool.shutdown(wait=False)
 
 
 @app.get("/")
 async def root():
     """Root endpoint - serve web interface"""
     try:
-        # Try to serve index.html from current directory
-        if os.path.exists("index.html"):
-            return FileResponse("index.html")
+        # Serve index.html resolved at startup
+        if app.state.index_path:
+            return FileResponse(app.state.index_path, stat_result=app.state.index_stat)
         else:
             return {
                 "status": "running",
@@ -101,7 +137,7 @@ async def root():
         }
 
 @app.post("/detect/{filename}")
-async def detect_copyright(filename: str):
+async def detect_copyright(filename: str, persist: bool = False):
     try:
         file_path = os.path.join(INPUT_PATH, filename)
 
@@ -122,21 +158,21 @@ async def detect_copyright(filename: str):
         logger.info(f"Processing file: {file_path}")
 
         #  run detection
-        result = audio_service.identify_audio(file_path)
+        result = await audio_service.identify_audio(file_path)
 
-        #  save JSON output
-        output_file = os.path.join(
-            OUTPUT_PATH,
-            f"{Path(filename).stem}_copyright.json"
-        )
+        #  save JSON output only when asked for
+        if persist:
+            output_file = os.path.join(
+                OUTPUT_PATH,
+                f"{Path(filename).stem}_copyright.json"
+            )
 
-        with open(output_file, "w") as f:
-            json.dump(result, f, indent=2)
+            await asyncio.to_thread(save_result, result, output_file)
 
-        logger.info(f"Saved result to: {output_file}")
+            logger.info(f"Saved result to: {output_file}")
 
-        # optional: include path in response
-        result["saved_to"] = output_file
+            # optional: include path in response
+            result["saved_to"] = output_file
 
         return result
 
@@ -147,7 +183,7 @@ async def detect_copyright(filename: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/detect-upload")
-async def detect_upload(file: UploadFile = File(...)):
+async def detect_upload(file: UploadFile = File(...), persist: bool = False):
     """Upload file and detect copyright"""
     try:
         # Validate format
@@ -157,23 +193,20 @@ async def detect_upload(file: UploadFile = File(...)):
                 detail="Invalid audio format. Supported: mp3, wav, flac, ogg, m4a, aac, aiff, wma"
             )
         
-        # Save uploaded file temporarily
-        file_path = await audio_service.save_upload(file)
-        
-        # Run detection
-        result = audio_service.identify_audio(file_path)
-        
-        # Save result to output folder
-        output_file = os.path.join(
-            OUTPUT_PATH,
-            f"{Path(file.filename).stem}_copyright.json"
-        )
-        
-        with open(output_file, "w") as f:
-            json.dump(result, f, indent=2)
+        # Run detection on the uploaded stream
+        result = await audio_service.identify_upload(file)
         
-        result["saved_to"] = output_file
-        logger.info(f"Upload detection saved to: {output_file}")
+        # Save result to output folder only when asked for
+        if persist:
+            output_file = os.path.join(
+                OUTPUT_PATH,
+                f"{Path(file.filename).stem}_copyright.json"
+            )
+            
+            await asyncio.to_thread(save_result, result, output_file)
+            
+            result["saved_to"] = output_file
+            logger.info(f"Upload detection saved to: {output_file}")
         
         return result
         
@@ -202,14 +235,12 @@ async def list_input_files():
     try:
         files = []
         if os.path.exists(INPUT_PATH):
-            for file in os.listdir(INPUT_PATH):
-                if audio_service.is_valid_audio_format(file):
-                    file_path = os.path.join(INPUT_PATH, file)
-                    files.append({
-                        "name": file,
-                        "size": os.path.getsize(file_path),
-                        "path": file_path
-                    })
+            with os.scandir(INPUT_PATH) as entries:
+                files = [
+                    {"name": entry.name, "size": entry.stat().st_size, "path": entry.path}
+                    for entry in entries
+                    if entry.is_file() and audio_service.is_valid_audio_format(entry.name)
+                ]
         return {"files": files, "count": len(files)}
     except Exception as e:
         logger.error(f"Error listing files: {str(e)}")
@@ -221,17 +252,7 @@ async def list_results():
     try:
         results = []
         if os.path.exists(OUTPUT_PATH):
-            for file in os.listdir(OUTPUT_PATH):
-                if file.endswith('.json'):
-                    result_path = os.path.join(OUTPUT_PATH, file)
-                    with open(result_path, 'r') as f:
-                        result_data = json.load(f)
-                        results.append({
-                            "filename": file,
-                            "status": result_data.get("status"),
-                            "file": result_data.get("file"),
-                            "title": result_data.get("top_match", {}).get("title") if result_data.get("status") == "found" else None
-                        })
+            results = audio_service.summarize_results(OUTPUT_PATH)
         return {"results": results, "count": len(results)}
     except Exception as e:
         logger.error(f"Error listing results: {str(e)}")